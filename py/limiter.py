@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 """
 Brick-wall limiter with true envelope follower, attack/release smoothing, 
-makeup gain, stereo support, and plotting.
+makeup gain, multichannel support, and block-wise streaming of WAV files.
+limiter(..., debug=True) also returns the envelope and gain buffers, eg. for
+plotting.
 Usage:
   python limiter_full.py \
     --input  input.wav \
@@ -9,21 +11,108 @@ Usage:
     [--threshold 0.1] [--attack_ms 5] [--release_ms 50]
 """
 import argparse
+import os
+import tempfile
 import numpy as np
-from scipy.io import wavfile
-from scipy.ndimage import maximum_filter1d
-import matplotlib.pyplot as plt
+import soundfile as sf
 
-def limiter(audio, sr, threshold, attack_ms, release_ms):
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    # no numba available; run the kernels below as plain python loops
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+    prange = range
+
+# kernels below work on one contiguous channel at a time; limiter() hands
+# them a (n_channels, n_samples) view so each recurrence walks memory linearly.
+# they all start from a carried-in previous value so a signal can be processed
+# in consecutive blocks (see limiter's `state`)
+
+@njit(cache=True, fastmath=True)
+def _env_follow(rect, aa, ar, out, prev):
+    for n in range(rect.shape[0]):
+        x    = rect[n]
+        a    = aa if x > prev else ar
+        prev = a * prev + (1 - a) * x
+        out[n] = prev
+
+@njit(cache=True, fastmath=True)
+def _release_smooth(gain_raw, ar, out, prev):
+    for n in range(gain_raw.shape[0]):
+        prev = max(gain_raw[n], prev * ar)
+        out[n] = prev
+
+def _release_smooth_np(gain_raw, ar, out, prev):
+    # vectorized form of _release_smooth for when numba is unavailable. in log
+    # space the recurrence is lg[n] = max(lg_raw[n], lg[n-1] + log(ar)), so
+    # subtracting the linearly growing n*log(ar) turns it into a plain
+    # cumulative max; the carried-in prev just seeds the first element
+    lar     = np.log(ar)
+    n       = np.arange(gain_raw.shape[0], dtype=np.float64)
+    shifted = np.log(np.maximum(gain_raw, 1e-30), dtype=np.float64) - n * lar
+    shifted[0] = max(shifted[0], np.log(max(prev, 1e-30)) + lar)
+    np.maximum.accumulate(shifted, out=shifted)
+    out[:] = np.exp(shifted + n * lar)
+
+@njit(cache=True, fastmath=True)
+def _limit_fused(x, aa, ar, thr, inv_thr, limited, state):
+    # same math as the staged path, but carries env/gain as scalar state
+    # and only ever writes the limited output
+    env_prev  = state[0]
+    gain_prev = state[1]
+    for n in range(x.shape[0]):
+        s = x[n]
+        r = abs(s)
+        a = aa if r > env_prev else ar
+        env_prev  = np.float32(a * env_prev + (1 - a) * r)
+        gr = min(1.0, thr / (env_prev + 1e-9))
+        gain_prev = np.float32(max(gr, gain_prev * ar))
+        limited[n] = min(1.0, max(-1.0, s * gain_prev * inv_thr))
+    state[0] = env_prev
+    state[1] = gain_prev
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _limit_channels(audio_soa, aa, ar, thr, inv_thr, limited_soa, state):
+    # channels are fully independent, so each one gets its own thread
+    for c in prange(audio_soa.shape[0]):
+        _limit_fused(audio_soa[c], aa, ar, thr, inv_thr, limited_soa[c], state[c])
+
+def _init_state(audio):
+    # the envelope starts at the first rectified sample; a zero previous gain
+    # means the first smoothed gain is just the first raw gain
+    state = np.zeros((audio.shape[1], 2), dtype=np.float32)
+    state[:, 0] = np.abs(audio[0])
+    return state
+
+def limiter(audio, sr, threshold, attack_ms, release_ms, debug=False, state=None, offset=0):
+    """
+    Returns (limited, env, gain_raw, gain). The intermediate envelope and gain
+    buffers are only returned when debug is set, and are None otherwise. With
+    numba available and debug unset, the whole chain runs as a single fused
+    pass.
+
+    To limit a long signal block by block, pass the same `state` array to each
+    call: a float32 array of shape (n_channels, 2) holding each channel's last
+    envelope and gain value, which is updated in place. If None, a fresh state
+    is seeded from the first sample (see _init_state). `offset` is the position
+    of the block's first sample in the whole signal, so reported sample indices
+    are file positions.
+    """
     # if given a 1D array, make it 2D; eg. size (12) becomes size (12, 1)
     if audio.ndim == 1:
         audio = audio[:, np.newaxis]
     n_samples, n_channels = audio.shape
 
-    for n in range(1, n_samples):
-        val = audio[n][0]
-        if abs(val) > 1.0:
-            print(f"got out of bounds input value: {val} at index {n}")
+    rectified     = np.abs(audio)
+    out_of_bounds = rectified > 1.0
+    if out_of_bounds.any():
+        idxs = np.flatnonzero(out_of_bounds.any(axis=1)) + offset
+        print(f"got {len(idxs)} out of bounds input samples; first at indices {idxs[:10]}")
 
     # time constants in seconds
     attack_tc  = attack_ms  / 1000.0
@@ -33,37 +122,136 @@ def limiter(audio, sr, threshold, attack_ms, release_ms):
     alpha_a = np.exp(-1.0 / (sr * attack_tc))
     alpha_r = np.exp(-1.0 / (sr * release_tc))
 
-    # rectify/abs the input signal
-    rectified = np.abs(audio)
+    # work channel-major so every per-channel pass is contiguous
+    audio_soa = np.ascontiguousarray(audio.T, dtype=np.float32)
+
+    # if nothing (including a carried-in envelope) reaches the threshold, the
+    # raw gain is 1 everywhere, so the smoothed gain is too and the limiter is
+    # just makeup gain and clip. the envelope still has to be followed if the
+    # caller is carrying state on to the next block
+    peak = max(rectified.max(), state[:, 0].max()) if state is not None else rectified.max()
+    if not debug and peak + 1e-9 <= threshold:
+        if state is not None:
+            env = np.abs(audio_soa)
+            for c in range(n_channels):
+                _env_follow(env[c], alpha_a, alpha_r, env[c], state[c, 0])
+            state[:, 0] = env[:, -1]
+            state[:, 1] = 1.0
+        limited = audio_soa * (1.0 / threshold)
+        np.clip(limited, -1.0, 1.0, out=limited)
+        return limited.T, None, None, None
+
+    if state is None:
+        state = _init_state(audio)
 
-    # 1) envelope follower (per-sample attack/release)
-    env      = np.zeros((n_samples, n_channels), dtype=np.float32)
-    env[0]   = np.abs(audio[0])
-    for n in range(1, n_samples):
-        x = rectified[n, :]
-        env[n] = np.where(x > env[n-1],
-                          alpha_a   * env[n-1] + (1 - alpha_a)   * x,
-                          alpha_r   * env[n-1] + (1 - alpha_r)   * x)
+    # without numba the fused kernel is a plain python loop, so fall through
+    # to the staged path where most of the work is vectorized
+    if not debug and HAVE_NUMBA:
+        limited_soa = np.empty_like(audio_soa)
+        _limit_channels(audio_soa, alpha_a, alpha_r, threshold, 1.0 / threshold, limited_soa, state)
+        return limited_soa.T, None, None, None
+
+    # intermediate buffers are reused in place where possible; the ones the
+    # caller gets to see in debug mode are kept separate
+
+    # rectify/abs the input signal, into the buffer that becomes the envelope
+    env = np.abs(audio_soa)
+
+    # 1) envelope follower (per-sample attack/release); safe to run in place
+    #    since each step only reads its own input sample and the previous output
+    for c in range(n_channels):
+        _env_follow(env[c], alpha_a, alpha_r, env[c], state[c, 0])
 
     # 2) raw gain to never exceed threshold
-    gain_raw = np.minimum(1.0, threshold / (env + 1e-9))
+    gain_raw = np.add(env, 1e-9, dtype=np.float32)
+    np.divide(threshold, gain_raw, out=gain_raw)
+    np.minimum(gain_raw, 1.0, out=gain_raw)
 
     # 3) smooth gain with release only
-    gain     = np.zeros_like(gain_raw)
-    gain[0]  = gain_raw[0]
-    for n in range(1, n_samples):
-        gain[n] = np.maximum(gain_raw[n], gain[n-1] * alpha_r)
+    gain = np.empty_like(gain_raw) if debug else gain_raw
+    release_smooth = _release_smooth if HAVE_NUMBA else _release_smooth_np
+    for c in range(n_channels):
+        release_smooth(gain_raw[c], alpha_r, gain[c], state[c, 1])
+
+    state[:, 0] = env[:, -1]
+    state[:, 1] = gain[:, -1]
 
     # 4) apply gain
-    limited  = audio * gain
+    limited = np.empty_like(gain) if debug else gain
+    np.multiply(audio_soa, gain, out=limited)
 
     # 5) makeup so threshold→1.0
     limited *= (1.0 / threshold)
 
     # 6) hard clip any peaks that have snuck through
-    limited = np.clip(limited, -1.0, 1.0)
+    np.clip(limited, -1.0, 1.0, out=limited)
+
+    # back to (n_samples, n_channels) for the caller
+    if not debug:
+        return limited.T, None, None, None
+    return limited.T, env.T, gain_raw.T, gain.T
 
-    return limited, env, gain_raw, gain
+def _positive_int(value):
+    n = int(value)
+    if n <= 0:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value}")
+    return n
+
+def _limit_file(in_path, out_path, args):
+    # stream the file through the limiter a block at a time, carrying the
+    # envelope/gain state across blocks, so memory use doesn't grow with the
+    # length of the input. soundfile handles the PCM <-> float conversion and
+    # the output keeps the input's sample format
+    state  = None
+    offset = 0
+    with sf.SoundFile(in_path) as fi, \
+         sf.SoundFile(out_path, 'w',
+                      samplerate=fi.samplerate,
+                      channels=fi.channels,
+                      subtype=fi.subtype,
+                      format=fi.format) as fo:
+        for block in fi.blocks(blocksize=args.block_size, dtype='float32', always_2d=True):
+            if state is None:
+                state = _init_state(block)
+            limited, env, gain_raw, gain = limiter(
+                block, fi.samplerate,
+                args.threshold,
+                args.attack_ms,
+                args.release_ms,
+                state=state,
+                offset=offset
+            )
+
+            # # plot envelope & gain (first channel); needs debug=True in the limiter call above,
+            # # and a --block_size at least as long as the file to see all of it in one plot
+            # times = (offset + np.arange(limited.shape[0])) / fi.samplerate
+            # import matplotlib.pyplot as plt
+            # plt.figure(figsize=(10,4))
+            # plt.plot(times, env[:,0],    label="Envelope")
+            # plt.plot(times, gain_raw[:,0],label="Raw Gain")
+            # plt.plot(times, gain[:,0],    label="Smoothed Gain")
+            # plt.title("Envelope & Gain (Ch 1)")
+            # plt.xlabel("Time [s]")
+            # plt.ylabel("Level")
+            # plt.legend()
+            # plt.tight_layout()
+            # plt.show()
+
+            # # plot waveforms (first channel)
+            # plt.figure(figsize=(10,4))
+            # plt.subplot(2,1,1)
+            # plt.plot(times, block[:,0],  label="Original")
+            # plt.ylim(-1.5, 1.5)
+            # plt.title("Original Waveform (Ch 1)")
+            # plt.subplot(2,1,2)
+            # plt.plot(times, limited[:,0],label="Limited")
+            # plt.ylim(-1.5, 1.5)
+            # plt.title("Limited Waveform (Ch 1)")
+            # plt.tight_layout()
+            # plt.show()
+
+            fo.write(limited)
+            offset += block.shape[0]
 
 def main():
     p = argparse.ArgumentParser(description="Brick-wall envelope-follower limiter")
@@ -72,63 +260,26 @@ def main():
     p.add_argument('-t','--threshold', type=float, default=0.5,  help="Limiter threshold (0-1)")
     p.add_argument(    '--attack_ms',  type=float, default=5.0,  help="Attack time constant (ms)")
     p.add_argument(    '--release_ms', type=float, default=50.0, help="Release time constant (ms)")
+    p.add_argument(    '--block_size', type=_positive_int, default=65536,
+                   help="Samples per processing block")
     args = p.parse_args()
 
-    # load
-    sr, data = wavfile.read(args.input)
-    orig_dtype = data.dtype
-    is_int     = np.issubdtype(orig_dtype, np.integer)
-    if is_int:
-        max_val = np.iinfo(orig_dtype).max
-        audio   = data.astype(np.float32) / max_val
-    else:
-        audio   = data.astype(np.float32)
-
-    # limit
-    limited, env, gain_raw, gain = limiter(
-        audio, sr,
-        args.threshold,
-        args.attack_ms,
-        args.release_ms
-    )
-
-    # time axis
-    times = np.arange(limited.shape[0]) / sr
-
-    # # plot envelope & gain (first channel)
-    # plt.figure(figsize=(10,4))
-    # plt.plot(times, env[:,0],    label="Envelope")
-    # plt.plot(times, gain_raw[:,0],label="Raw Gain")
-    # plt.plot(times, gain[:,0],    label="Smoothed Gain")
-    # plt.title("Envelope & Gain (Ch 1)")
-    # plt.xlabel("Time [s]")
-    # plt.ylabel("Level")
-    # plt.legend()
-    # plt.tight_layout()
-    # plt.show()
-
-    # # plot waveforms (first channel)
-    # plt.figure(figsize=(10,4))
-    # plt.subplot(2,1,1)
-    # plt.plot(times, audio[:,0],  label="Original")
-    # plt.ylim(-1.5, 1.5)
-    # plt.title("Original Waveform (Ch 1)")
-    # plt.subplot(2,1,2)
-    # plt.plot(times, limited[:,0],label="Limited")
-    # plt.ylim(-1.5, 1.5)
-    # plt.title("Limited Waveform (Ch 1)")
-    # plt.tight_layout()
-    # plt.show()
-
-    # write output
-    if is_int:
-        out = (limited * max_val).astype(orig_dtype)
-    else:
-        out = limited
-    # flatten mono
-    if out.ndim==2 and out.shape[1]==1:
-        out = out[:,0]
-    wavfile.write(args.output, sr, out)
+    # the input is still being read while the output is written, so limiting a
+    # file onto itself goes through a temp file next to it, which then replaces
+    # the original
+    if not (os.path.exists(args.output) and os.path.samefile(args.input, args.output)):
+        _limit_file(args.input, args.output, args)
+        return
+
+    out_dir = os.path.dirname(os.path.abspath(args.output))
+    fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(args.output)[1], dir=out_dir)
+    os.close(fd)
+    try:
+        _limit_file(args.input, tmp_path, args)
+        os.replace(tmp_path, args.output)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 if __name__=="__main__":
     main()
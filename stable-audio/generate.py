@@ -5,41 +5,78 @@ Generate audio using Stability AI's Stable Audio Open 1.0 model.
 Usage (after creating a Conda env at ./.conda-env):
   conda run --prefix ./.conda-env python stable-audio/generate.py \
       --prompt "128 BPM tech house drum loop" --output output.wav
+
+Pass --toml to read a TOML prompt from stdin instead, or --serve to keep the model loaded and
+handle JSON requests from stdin one line at a time (with a JSON status line per request on
+stdout, and all logging on stderr).
 """
-import atexit
 import os
-import shutil
+import pickle
+import random
 import sys
-import tempfile
-from functools import reduce
-import tomllib
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext, redirect_stdout
+from functools import lru_cache
 from typing import TextIO
 
-import numpy as np
-from stable_audio_tools import get_pretrained_model
-
-# Reduce fragmentation in PyTorch allocator
-os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+# Reduce fragmentation in PyTorch allocator: grow segments in place, and start reclaiming unused
+# cached blocks once usage passes 80% of the limit, before it turns into an OOM. max_split_size_mb
+# is left out on purpose; it doesn't combine reliably with expandable segments
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF",
+    "expandable_segments:True,garbage_collection_threshold:0.8",
+)
 
 import argparse
-import json
 
 from enum import Enum
 from pathlib import Path
 from sys import stdin
-from tomllib import loads
+
+# Prefer the C/Rust-backed parsers when they're installed, since parsing is on the startup path of
+# every invocation; fall back to the stdlib ones otherwise
+try:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+except ImportError:
+    import json
+
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+try:
+    import rtoml
+
+    toml_loads = rtoml.loads
+    TOMLDecodeError = rtoml.TomlParsingError
+except ImportError:
+    import tomllib
+
+    toml_loads = tomllib.loads
+    TOMLDecodeError = tomllib.TOMLDecodeError
 
 import torch
 import torchaudio
-from einops import rearrange
-from stable_audio_tools.models.factory import create_model_from_config
-from stable_audio_tools.models.utils import load_ckpt_state_dict
-from stable_audio_tools.models.utils import copy_state_dict
-from stable_audio_tools.inference.generation import (
-    generate_diffusion_cond,
-    generate_diffusion_cond_inpaint,
-)
-from stable_audio_tools.inference.utils import prepare_audio
+
+# Let cuBLAS/cuDNN pick the fast paths before anything gets built: TF32 for the fp32 matmuls and
+# convs still in the pipeline (eg. the text encoder and VAE), and autotuned conv algorithms, since
+# shapes are fixed for a whole run. These are no-ops without CUDA
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+torch.set_float32_matmul_precision("high")
+
+# NOTE: stable_audio_tools is slow to import (it pulls in most of its model zoo), so it's
+# imported inside the functions that need it rather than here; that keeps eg. `--help` and
+# bad-input exits fast
 
 STABLE_AUDIO_OPEN_1_0_PATH = "models/stable-audio-open-1.0"
 STABLE_AUDIO_OPEN_SMALL_PATH = "models/stable-audio-open-small"
@@ -52,14 +89,38 @@ default_cfg = {
     "length": 30,
     "steps": 100,
     "cfg_scale": 7.0,
+    "no_guidance": False,
     "sampler": "dpmpp-3m-sde",
     "progress_file": None,
     "init_audio": None,
     "seed": -1,
     "small": False,
+    "compile": False,
+    "compile_mode": "reduce-overhead",
+}
+
+# Step count for simple prompts that don't give --steps (or a --preset); TOML prompts keep using
+# default_cfg's
+SIMPLE_PROMPT_STEPS = 50
+
+# Named step count/sampler combinations. Sampling time is linear in the step count, so "fast" takes
+# roughly a third of the time of "quality", at the cost of some detail and prompt adherence. An
+# explicit --steps/--sampler (or config value) still takes precedence over the preset
+PRESETS = {
+    "fast": {"steps": 30, "sampler": "dpmpp-2m-sde"},
+    "quality": {"steps": 100, "sampler": "dpmpp-3m-sde"},
 }
 
 
+def preset_cfg(name) -> dict:
+    """Look up the settings for a named preset; no preset means no overrides"""
+    if name is None:
+        return {}
+    if name not in PRESETS:
+        raise ValueError(f"Unknown preset '{name}' (expected one of {', '.join(PRESETS)})")
+    return PRESETS[name]
+
+
 class InvocationType(Enum):
     AUDIO2AUDIO = 1  # Unused
     SPROMPT = 2
@@ -71,11 +132,19 @@ class ProgressWriter:
     """
     Wraps a stream to capture tqdm-style progress bars (which use '\r')
     and write the latest line to a file on each carriage return.
+
+    The file is kept open and overwritten in place, at most every `interval` seconds; the
+    reader polls it and skips empty reads, so it never sees the truncated state.
     """
 
-    def __init__(self, stream: TextIO, fname: str) -> None:
+    def __init__(self, stream: TextIO, fname: str, interval: float = 0.1) -> None:
         self._stream = stream
-        self._fname = fname
+        self._interval = interval
+        self._last = float("-inf")
+        try:
+            self._fh = open(fname, "w")
+        except Exception:
+            self._fh = None
 
     def write(self, data: str) -> None:
         # Forward incoming data back to the original stream
@@ -83,35 +152,136 @@ class ProgressWriter:
 
         # If it doesn't start with a carriage return, it's probably not a progress bar,
         # so just skip it
-        if not data or data[0] != "\r":
+        if not data or data[0] != "\r" or self._fh is None:
             return
 
+        now = time.monotonic()
+        if now - self._last < self._interval:
+            return
+        self._last = now
+
         try:
-            with open(self._fname, "w") as f:
-                f.write("`" + data[1:].rstrip("\n") + "`")
+            self._fh.seek(0)
+            self._fh.truncate()
+            self._fh.write("`" + data[1:].rstrip("\n") + "`")
+            self._fh.flush()
         except Exception:
             pass
 
     def flush(self) -> None:
         self._stream.flush()
 
+    def close(self) -> None:
+        """Close the progress file; the wrapped stream is left open"""
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
 
+@lru_cache(maxsize=1)
 def get_project_dir(start_dir: Path = Path.cwd()) -> Path:
-    """Walk upward until a .git directory is found"""
+    """Walk upward until a .git directory is found; cached, since the answer can't change"""
     for p in (start_dir, *start_dir.parents):
         if (p / ".git").is_dir():
             return p
     raise FileNotFoundError(f"No project dir found as a parent of '{start_dir}'")
 
 
-def trim_audio_inplace(filepath, seconds):
-    audio, sample_rate = torchaudio.load(filepath)
-    num_samples = int(seconds * sample_rate)
-    trimmed_audio = audio[:, :num_samples]
+# Per-model conditioning caches, held weakly so a model evicted from load_model's cache can
+# still be freed
+_conditioning_caches = weakref.WeakKeyDictionary()
+CONDITIONING_CACHE_SIZE = 64
 
-    tmp_out = filepath + ".trimmed.tmp.wav"
-    torchaudio.save(tmp_out, trimmed_audio, sample_rate)
-    os.replace(tmp_out, filepath)
+
+def get_conditioning(model, prompt, seconds_total, device) -> dict:
+    """
+    Run the model's conditioner (ie. the text encoder) for a single prompt, memoized per model
+    so repeated prompts (like the empty unconditional one) only get encoded once. Returns a
+    fresh dict each time so callers can swap out entries without touching the cached copy.
+    """
+    cache = _conditioning_caches.setdefault(model, OrderedDict())
+    key = (prompt, seconds_total, device)
+    if key in cache:
+        cache.move_to_end(key)
+    else:
+        spec = [{"prompt": prompt, "seconds_start": 0, "seconds_total": seconds_total}]
+        cache[key] = model.conditioner(spec, device)
+        if len(cache) > CONDITIONING_CACHE_SIZE:
+            cache.popitem(last=False)
+    return dict(cache[key])
+
+
+def weighted_prompt_embeddings(model, prompt_lists, seconds_total, device, template) -> list:
+    """
+    Encode every non-zero-weighted prompt across all of `prompt_lists` (eg. the positive and
+    negative prompts) in a single batched conditioner call, and return each list's weighted sum,
+    shaped like `template` (ie. a (1, T, D) prompt embedding)
+    """
+    active_lists = [[elem for elem in prompts if elem["weight"] != 0] for prompts in prompt_lists]
+    active = [elem for elems in active_lists for elem in elems]
+    if not active:
+        return [torch.zeros_like(template) for _ in prompt_lists]
+
+    specs = [
+        {"prompt": elem["prompt"], "seconds_start": 0, "seconds_total": seconds_total}
+        for elem in active
+    ]
+    embeddings = model.conditioner(specs, device)["prompt"][0]  # (N, T, D)
+    # Accumulate in fp32 so lots of small weights don't lose precision under fp16/bf16
+    weights = torch.tensor(
+        [elem["weight"] for elem in active], device=embeddings.device, dtype=torch.float32
+    )
+
+    sums = []
+    start = 0
+    for elems in active_lists:
+        if not elems:
+            sums.append(torch.zeros_like(template))
+            continue
+        end = start + len(elems)
+        weighted = torch.einsum("k,ktd->td", weights[start:end], embeddings[start:end].float())
+        sums.append(weighted.to(embeddings.dtype).unsqueeze(0))
+        start = end
+    return sums
+
+
+def build_inpaint_mask(time_ranges, sample_rate, n_samples, sample_size, device):
+    """
+    Build a (1, sample_size) mask that's 0 inside any of the given (start_sec, end_sec) ranges
+    (clamped to the first `n_samples` samples) and 1 everywhere else, in one vectorized pass
+    """
+    inpaint_mask = torch.ones(1, sample_size, device=device)
+    time_ranges = list(time_ranges)
+    if not time_ranges:
+        return inpaint_mask
+
+    # Clamp to audio bounds; empty or inverted ranges just never match below
+    starts = torch.tensor(
+        [max(0, int(start_sec * sample_rate)) for start_sec, _ in time_ranges], device=device
+    )
+    ends = torch.tensor(
+        [min(n_samples, int(end_sec * sample_rate)) for _, end_sec in time_ranges], device=device
+    )
+    idx = torch.arange(sample_size, device=device)
+    in_any_range = ((idx[None, :] >= starts[:, None]) & (idx[None, :] < ends[:, None])).any(dim=0)
+    return inpaint_mask.masked_fill_(in_any_range[None, :], 0)
+
+
+def attention_backends(device):
+    """
+    Restrict scaled_dot_product_attention to the fused flash/memory-efficient kernels on CUDA, so
+    the sampler never silently falls back to the (much slower, memory-hungry) math backend
+    """
+    if device.type != "cuda":
+        return nullcontext()
+    try:
+        from torch.nn.attention import SDPBackend, sdpa_kernel
+    except ImportError:
+        # torch < 2.3
+        return torch.backends.cuda.sdp_kernel(
+            enable_flash=True, enable_mem_efficient=True, enable_math=False
+        )
+    return sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
 
 
 def infer(
@@ -125,7 +295,9 @@ def infer(
     seed,
     target_sample_rate,
 ):
-    with torch.no_grad():
+    from stable_audio_tools.inference.generation import generate_diffusion_cond
+
+    with torch.inference_mode(), attention_backends(device):
         output = generate_diffusion_cond(
             model,
             steps=args["steps"],
@@ -156,7 +328,9 @@ def infer_inpaint(
     seed,
     target_sample_rate,
 ):
-    with torch.no_grad():
+    from stable_audio_tools.inference.generation import generate_diffusion_cond_inpaint
+
+    with torch.inference_mode(), attention_backends(device):
         output = generate_diffusion_cond_inpaint(
             model,
             steps=args["steps"],
@@ -177,38 +351,210 @@ def infer_inpaint(
     return output
 
 
-def shared_model_invocation(args, inv_type) -> None:
+def get_model_dtype(device) -> torch.dtype:
+    """
+    Pick the precision to run the model at: bf16 on Ampere or newer GPUs (same throughput as fp16
+    but with fp32's exponent range), fp16 on older GPUs, and full fp32 on CPU
+    """
+    if device.type != "cuda":
+        return torch.float32
+    if torch.cuda.get_device_capability(device) >= (8, 0):
+        return torch.bfloat16
+    return torch.float16
+
+
+def prefetch_checkpoint(ckpt_path) -> None:
+    """
+    Ask the OS to start reading the checkpoint into the page cache in the background, so loading
+    it after the model has been built mostly hits warm pages. Best-effort, and a no-op where
+    posix_fadvise isn't available
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    def advise():
+        try:
+            fd = os.open(str(ckpt_path), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    threading.Thread(target=advise, daemon=True).start()
+
+
+def load_checkpoint(model, ckpt_path) -> None:
+    """Load checkpoint weights into `model`, memory-mapping torch checkpoints where possible"""
+    from stable_audio_tools.models.utils import copy_state_dict, load_ckpt_state_dict
+
+    state_dict = None
+    if Path(ckpt_path).suffix != ".safetensors":
+        try:
+            ckpt = torch.load(str(ckpt_path), map_location="cpu", mmap=True, weights_only=True)
+            state_dict = ckpt.get("state_dict", ckpt)
+        except (RuntimeError, pickle.UnpicklingError) as e:
+            print(f"Couldn't memory-map checkpoint ({e}); loading it normally")
+
+    if state_dict is None:
+        copy_state_dict(model, load_ckpt_state_dict(str(ckpt_path)))
+        return
+
+    # Same filtering as copy_state_dict: only take weights the model has, with matching shapes
+    model_state_dict = model.state_dict()
+    state_dict = {
+        k: v
+        for k, v in state_dict.items()
+        if k in model_state_dict and v.shape == model_state_dict[k].shape
+    }
+    model.load_state_dict(state_dict, strict=False, assign=True)
+
+
+def compile_enabled(flag: bool) -> bool:
+    """Whether torch.compile was asked for, either directly or through SLUGBOT_COMPILE=1"""
+    return flag or os.environ.get("SLUGBOT_COMPILE") == "1"
+
+
+def create_model(model_config, ckpt_path, device):
+    """
+    Instantiate the model from its config, load the local checkpoint weights, and prepare it
+    for inference on `device`
+    """
+    from stable_audio_tools.models.factory import create_model_from_config
+
+    # Overlap reading the (multi-GB) checkpoint off disk with building the model
+    prefetch_checkpoint(ckpt_path)
+
+    print("Creating model from config...", flush=True)
+    model = create_model_from_config(model_config)
+
+    # Load weights from local checkpoint
+    print(f"Loading checkpoint from {ckpt_path}", flush=True)
+    load_checkpoint(model, ckpt_path)
+
+    # Move model to device, set precision, and disable gradients
+    model = model.to(device=device, dtype=get_model_dtype(device))
+    model.eval().requires_grad_(False)
+
+    return model
+
+
+def compile_backbone(model, device, compile_mode="reduce-overhead") -> None:
+    """
+    Compile the model's diffusion backbone (the DiT inside its wrapper) in place, since that's
+    what runs once per sampling step. Shapes are fixed for a run, so a static graph is enough.
+    Only the first call per model compiles; later ones keep that compiled backbone
+    """
+    if device.type != "cuda":
+        return
+    if not hasattr(torch, "compile"):
+        print("torch.compile needs PyTorch 2.0 or later; running the model eagerly")
+        return
+    wrapper = model.model
+    if hasattr(wrapper.model, "_orig_mod"):
+        return
+    print(f"Compiling diffusion model (mode={compile_mode})...", flush=True)
+    wrapper.model = torch.compile(wrapper.model, mode=compile_mode, fullgraph=False, dynamic=False)
+
+
+def to_pcm16(audio: torch.Tensor) -> torch.Tensor:
+    """Peak-normalize `audio` to full scale as int16 PCM; fp32 input is overwritten in place"""
+    audio = audio.to(torch.float32)
+    lo, hi = torch.aminmax(audio)
+    peak = torch.maximum(hi, -lo).clamp_min_(1e-8)
+    return audio.mul_(32767 / peak).clamp_(-32767, 32767).to(torch.int16)
+
+
+@lru_cache(maxsize=2)
+def pcm16_converter(compiled: bool):
+    """Return `to_pcm16`, wrapped in torch.compile if `compiled` is set and available"""
+    if compiled and hasattr(torch, "compile"):
+        return torch.compile(to_pcm16, dynamic=False)
+    return to_pcm16
+
+
+@lru_cache(maxsize=4)
+def _pinned_buffer(shape, dtype) -> torch.Tensor:
+    return torch.empty(shape, dtype=dtype, pin_memory=True)
+
+
+def to_host(tensor: torch.Tensor) -> torch.Tensor:
+    """Copy a tensor to the CPU; the result is only valid until the next call with the same shape"""
+    if tensor.device.type != "cuda":
+        return tensor.cpu()
+    host = _pinned_buffer(tuple(tensor.shape), tensor.dtype)
+    host.copy_(tensor, non_blocking=True)
+    torch.cuda.current_stream(tensor.device).synchronize()
+    return host
+
+
+def get_device() -> torch.device:
+    return torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+
+@lru_cache(maxsize=2)
+def load_model(small: bool):
+    """
+    Load either Stable Audio Open 1.0 or Small onto the default device, returning the model and
+    its config. Cached, so a long-running process (see `serve`) only loads each model once
+    """
     project_dir = get_project_dir()
+    model_dir = project_dir / (STABLE_AUDIO_OPEN_SMALL_PATH if small else STABLE_AUDIO_OPEN_1_0_PATH)
+    config_path = model_dir / "model_config.json"
+    ckpt_path = model_dir / "model.ckpt"
 
-    # Switch between models
-    if args["small"]:
-        config_path = (project_dir / STABLE_AUDIO_OPEN_SMALL_PATH) / "model_config.json"
-        ckpt_path = (project_dir / STABLE_AUDIO_OPEN_SMALL_PATH) / "model.ckpt"
-        # manually override sampler, since SAO Small only supports pingpong sampler
-        args["sampler"] = "pingpong"
-        args["cfg_scale"] = args.get("cfg_scale", 6.0)
-    else:
-        config_path = (project_dir / STABLE_AUDIO_OPEN_1_0_PATH) / "model_config.json"
-        ckpt_path = (project_dir / STABLE_AUDIO_OPEN_1_0_PATH) / "model.ckpt"
+    # Load model configuration
+    print(f"Loading model config from {config_path}", flush=True)
+    with open(config_path, "rb") as f:
+        model_config = json_loads(f.read())
+
+    model = create_model(model_config, ckpt_path, get_device())
+    return model, model_config
 
-    # If a progress file was indicated, create it to track progress, then delete it on cleanup
-    if args["progress_file"] is not None:
+
+@contextmanager
+def progress_reporting(progress_file):
+    """
+    If a progress file was indicated, create it and mirror progress bars from stderr into it for
+    the duration of the block, then delete it again
+    """
+    if progress_file is None:
+        yield
+        return
+
+    stderr = sys.stderr
+    writer = ProgressWriter(stderr, progress_file)
+    sys.stderr = writer
+    try:
+        yield
+    finally:
+        sys.stderr = stderr
+        writer.close()
         try:
-            open(args["progress_file"], "w").close()
-        except Exception:
+            os.remove(progress_file)
+        except OSError:
             pass
 
-        def _cleanup():
-            try:
-                os.remove(args["progress_file"])
-            except OSError:
-                pass
 
-        atexit.register(_cleanup)
-        sys.stderr = ProgressWriter(sys.stderr, args["progress_file"])
+def shared_model_invocation(args, inv_type) -> None:
+    with progress_reporting(args["progress_file"]):
+        _invoke_model(args, inv_type)
+
+
+def _invoke_model(args, inv_type) -> None:
+    if args["small"]:
+        # manually override sampler, since SAO Small only supports pingpong sampler
+        args["sampler"] = "pingpong"
+        args["cfg_scale"] = args.get("cfg_scale", 6.0)
+
+    if args["no_guidance"]:
+        args["cfg_scale"] = 1.0
 
     # Select device
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    device = get_device()
     print(f"Using device: {device}", flush=True)
 
     # Parse the seed if it's present
@@ -217,37 +563,30 @@ def shared_model_invocation(args, inv_type) -> None:
         raise ValueError("Seed must be >= -1")
     if seed == -1:
         # The geniuses at stable-audio didn't realize that 2^32-1 is out of bounds for a signed integer
-        seed = np.random.randint(0, 2**31 - 1)
+        seed = random.randrange(0, 2**31 - 1)
     print(f"Using seed: {seed}")
 
-    # Load model configuration
-    print(f"Loading model config from {config_path}", flush=True)
-    with open(config_path) as f:
-        model_config = json.load(f)
+    # Load the model outside of inference mode; any tensors created under it become inference
+    # tensors, which would leave the (cached) model's parameters unusable elsewhere
+    model, model_config = load_model(args["small"])
+    # Compilation takes a while and every CLI invocation is a fresh process, so it's opt-in; in
+    # `serve` the cached model stays compiled for every later request once one asks for it
+    if compile_enabled(args["compile"]):
+        compile_backbone(model, device, args["compile_mode"])
 
-    if args["length"] != default_cfg["length"]:
-        model_config["sample_size"] = model_config["sample_rate"] * args["length"]
+    _generate(args, inv_type, model, model_config, device, seed)
 
-    # Instantiate model
-    print("Creating model from config...", flush=True)
-    print(f"Model config's sample_size is {model_config['sample_size']}")
-    model = create_model_from_config(model_config)
-
-    # Load weights from local checkpoint
-    print(f"Loading checkpoint from {ckpt_path}", flush=True)
-    state_dict = load_ckpt_state_dict(str(ckpt_path))
-    copy_state_dict(model, state_dict)
-
-    # Move model to device, set precision, and disable gradients
-    model = model.to(device)
-    if device.type == "cuda":
-        model = model.half()
-    model.eval()
-    for p in model.parameters():
-        p.requires_grad = False
 
+@torch.inference_mode()
+def _generate(args, inv_type, model, model_config, device, seed) -> None:
+    # Everything from conditioning through to the saved output runs in inference mode, since
+    # none of it needs autograd. This covers the conditioner calls and the PCM16 conversion,
+    # not just the sampling loop in infer()/infer_inpaint()
     target_sample_rate = int(model_config.get("sample_rate"))
     sample_size = int(model_config.get("sample_size"))
+    if args["length"] != default_cfg["length"]:
+        sample_size = int(target_sample_rate * args["length"])
+    print(f"Using sample_size {sample_size}")
 
     n_samples = args["length"] * target_sample_rate
 
@@ -256,52 +595,47 @@ def shared_model_invocation(args, inv_type) -> None:
         print(f"Using input audio file '{args['init_audio']}'")
         in_waveform, in_sample_rate = torchaudio.load(args["init_audio"])
         in_waveform = in_waveform[..., : int(in_sample_rate * args["length"])]
+        # Move to the device first so the resampling filter runs there rather than on the CPU; it
+        # stays in fp32 until after resampling. On CUDA the upload goes through pinned memory so
+        # it's a single asynchronous DMA
+        if device.type == "cuda":
+            in_waveform = in_waveform.pin_memory()
+        in_waveform = in_waveform.to(device, non_blocking=True)
         if in_sample_rate != target_sample_rate:
             print(
                 f"Resampling input audio from sample rate {in_sample_rate} to {target_sample_rate}..."
             )
-            resampler = torchaudio.transforms.Resample(
-                orig_freq=in_sample_rate, new_freq=target_sample_rate
+            in_waveform = torchaudio.functional.resample(
+                in_waveform, orig_freq=in_sample_rate, new_freq=target_sample_rate
             )
-            in_waveform = resampler(in_waveform)
             in_sample_rate = target_sample_rate
             print("...done resampling")
-        in_waveform = in_waveform.to(device)
-        if device.type == "cuda":
-            print("Converting input audio to 16-bit...")
-            in_waveform = in_waveform.half()
+        model_dtype = get_model_dtype(device)
+        if in_waveform.dtype != model_dtype:
+            print(f"Converting input audio to {model_dtype}...")
+            in_waveform = in_waveform.to(model_dtype)
             print("...done converting")
         audio2audio_conditioning = (in_sample_rate, in_waveform)
 
-    # Warm up GPU allocator
-    if device.type == "cuda":
-        torch.cuda.empty_cache()
-
     conditioning_tensors = None
     negative_conditioning_tensors = None
 
+    # With cfg_scale == 1 the sampler skips classifier-free guidance entirely (one model forward
+    # per step instead of a doubled batch), so there's no point encoding any negative prompts
+    guided = args["cfg_scale"] != 1.0
+
     output = None
     match inv_type:
         case InvocationType.SPROMPT:
-            conditioning = [
-                {
-                    "prompt": args["prompt"],
-                    "seconds_start": 0,
-                    "seconds_total": args["length"],
-                }
-            ]
-            conditioning_tensors = model.conditioner(conditioning, device)
-
-            negative_conditioning = None
-            if args["negative_prompt"] is not None:
-                negative_conditioning = [
-                    {
-                        "prompt": args["negative_prompt"],
-                        "seconds_start": 0,
-                        "seconds_total": args["length"],
-                    }
-                ]
-                negative_conditioning_tensors = model.conditioner(negative_conditioning, device)
+            conditioning_tensors = get_conditioning(model, args["prompt"], args["length"], device)
+
+            # An empty negative prompt (which is what the bot sends when none was given) means no
+            # negative prompt, rather than guiding away from the encoding of ""
+            negative_prompt = (args["negative_prompt"] or "").strip()
+            if guided and negative_prompt:
+                negative_conditioning_tensors = get_conditioning(
+                    model, negative_prompt, args["length"], device
+                )
 
             print(f"Generating {args['length']}s audio with {args['steps']} steps and cfg_scale={args['cfg_scale']}...", flush=True)
             output = infer(
@@ -317,57 +651,33 @@ def shared_model_invocation(args, inv_type) -> None:
             )
 
         case InvocationType.NPROMPT | InvocationType.INPAINT:
-            uncond_spec = [{"prompt": "", "seconds_start": 0, "seconds_total": args["length"]}]
-            uncond_tensors_batched = model.conditioner(uncond_spec, device)
-            uncond_negative_tensors_batched = model.conditioner(uncond_spec, device)
-
-            # Initialize a zero tensor with the correct shape and device for the sum
-            prompt_embedding_template = uncond_tensors_batched["prompt"][0]
-            prompt_embedding_template = torch.zeros_like(prompt_embedding_template)
-
-            # Iterate through prompts and their weights
-            for elem in args["prompts"]:
-                prompt_text = elem["prompt"]
-                weight = elem["weight"]
-                if weight == 0:
-                    continue
-
-                current_prompt_spec = [
-                    {"prompt": prompt_text, "seconds_start": 0, "seconds_total": args["length"]}
-                ]
-                current_cond_tensor = model.conditioner(current_prompt_spec, device)["prompt"][0]
-
-                prompt_embedding_template += weight * current_cond_tensor
+            # The negative side starts from the same unconditional tensors; only its "prompt" entry
+            # gets swapped out below (never modified in place), so a shallow copy is enough
+            uncond_tensors_batched = get_conditioning(model, "", args["length"], device)
+            uncond_negative_tensors_batched = dict(uncond_tensors_batched)
+
+            # Weighted sums of the prompt (and negative prompt) embeddings, all encoded as one batch
+            use_neg_prompts = guided and args.get("neg_prompts") is not None
+            prompt_lists = [args["prompts"]]
+            if use_neg_prompts:
+                prompt_lists.append(args["neg_prompts"])
+            prompt_embeddings = weighted_prompt_embeddings(
+                model,
+                prompt_lists,
+                args["length"],
+                device,
+                uncond_tensors_batched["prompt"][0],
+            )
 
             uncond_tensors_batched["prompt"] = (
-                prompt_embedding_template,
+                prompt_embeddings[0],
                 uncond_tensors_batched["prompt"][1],
             )
             conditioning_tensors = uncond_tensors_batched
 
-            if args.get("neg_prompts") is not None:
-                negative_prompt_embedding_template = uncond_tensors_batched["prompt"][0]
-                negative_prompt_embedding_template = torch.zeros_like(
-                    negative_prompt_embedding_template
-                )
-
-                for elem in args["neg_prompts"]:
-                    prompt_text = elem["prompt"]
-                    weight = elem["weight"]
-                    if weight == 0:
-                        continue
-
-                    current_prompt_spec = [
-                        {"prompt": prompt_text, "seconds_start": 0, "seconds_total": args["length"]}
-                    ]
-                    current_cond_tensor = model.conditioner(current_prompt_spec, device)["prompt"][
-                        0
-                    ]
-
-                    negative_prompt_embedding_template += weight * current_cond_tensor
-
+            if use_neg_prompts:
                 uncond_negative_tensors_batched["prompt"] = (
-                    negative_prompt_embedding_template,
+                    prompt_embeddings[1],
                     uncond_negative_tensors_batched["prompt"][1],
                 )
                 negative_conditioning_tensors = uncond_negative_tensors_batched
@@ -375,19 +685,9 @@ def shared_model_invocation(args, inv_type) -> None:
             if inv_type == InvocationType.INPAINT:
                 print(f"Inpainting {args['init_audio']} with {args['steps']} steps and cfg_scale={args['cfg_scale']}...", flush=True)
 
-                inpaint_mask = torch.ones(1, sample_size, device=device)
-                for _slice_name, time_range_seconds in args["inpaint"].items():
-                    start_sec, end_sec = time_range_seconds
-
-                    start_sample = int(start_sec * target_sample_rate)
-                    end_sample = int(end_sec * target_sample_rate)
-
-                    # Clamp to audio bounds and ensure valid range
-                    start_sample = max(0, start_sample)
-                    end_sample = min(n_samples, end_sample)
-
-                    if start_sample < end_sample:
-                        inpaint_mask[start_sample:end_sample] = 0
+                inpaint_mask = build_inpaint_mask(
+                    args["inpaint"].values(), target_sample_rate, n_samples, sample_size, device
+                )
 
                 output = infer_inpaint(
                     args,
@@ -418,20 +718,37 @@ def shared_model_invocation(args, inv_type) -> None:
                     target_sample_rate,
                 )
 
-    if device.type == "cuda":
-        torch.cuda.empty_cache()
+    # Normalize to PCM16 and reshape on-device, then transfer to host once (as int16, so half
+    # the bytes of fp32)
+    use_compiled = compile_enabled(args["compile"]) and device.type == "cuda"
+    audio = pcm16_converter(use_compiled)(output)
+    # (b, d, n) -> (d, b * n); with a single generation (b == 1) this is just a view
+    audio = audio.transpose(0, 1).reshape(audio.shape[1], -1)
 
-    # Reshape and normalize to PCM16
-    audio = rearrange(output, "b d n -> d (b n)")
-    audio = audio.to(torch.float32)
-    audio = audio.div(torch.max(torch.abs(audio))).clamp(-1, 1)
-    audio = audio.mul(32767).to(torch.int16).cpu()
+    # sample_size may overshoot the requested length, so trim here rather than after saving
+    audio = to_host(audio[:, : int(args["length"] * target_sample_rate)])
 
     # Save output
     torchaudio.save(args["output"], audio, target_sample_rate)
     print(f"Saved audio to {args['output']}", flush=True)
 
-    trim_audio_inplace(args["output"], args["length"])
+
+def simple_prompt_args(given: dict) -> dict:
+    """
+    Build the args for a simple prompt from the values that were given (None meaning not given),
+    on top of the simple-prompt defaults; shared by the CLI and simple-prompt `serve` requests
+    """
+    args = {
+        **default_cfg,
+        "steps": SIMPLE_PROMPT_STEPS,
+        **preset_cfg(given.get("preset")),
+        **{k: v for k, v in given.items() if v is not None},
+    }  # Overwrite default vals when specified
+
+    if args["init_audio"] is not None and args["cfg_scale"] == default_cfg["cfg_scale"]:
+        args["cfg_scale"] = 125.0
+
+    return args
 
 
 def simple_prompt() -> None:
@@ -444,8 +761,22 @@ def simple_prompt() -> None:
     parser.add_argument("--output", help="Output WAV file path")
     parser.add_argument("--length", type=float, help="Length in seconds")
     parser.add_argument("--steps", type=int, help="Number of diffusion steps")
-    parser.add_argument("--cfg_scale", type=float, default=7.0, help="CFG scale")
+    parser.add_argument(
+        "--cfg_scale", type=float, default=default_cfg["cfg_scale"], help="CFG scale"
+    )
+    parser.add_argument(
+        "--no_guidance",
+        action="store_true",
+        help="If set, forces cfg_scale=1.0, which skips classifier-free guidance; roughly twice as "
+        "fast per step, but follows the prompt (and ignores any negative prompt) much less closely",
+    )
     parser.add_argument("--sampler", help="Sampler type")
+    parser.add_argument(
+        "--preset",
+        choices=list(PRESETS),
+        help="Step count and sampler preset: 'fast' (30 steps, dpmpp-2m-sde) or 'quality' "
+        "(100 steps, dpmpp-3m-sde); defaults to 50 steps of dpmpp-3m-sde",
+    )
     parser.add_argument("--progress_file", help="File to write progress output to")
     parser.add_argument("--init_audio", help="Path to a WAV file to condition on (audio2audio)")
     parser.add_argument(
@@ -454,14 +785,18 @@ def simple_prompt() -> None:
     parser.add_argument(
         "--small", action="store_true", help="If set, uses the small version of Stable Audio Open"
     )
-    args = parser.parse_args().__dict__
-    args = {
-        **default_cfg,
-        **{k: v for k, v1 in args.items() if (v := v1) is not None},
-    }  # Overwrite default vals when specified
-
-    if args["init_audio"] is not None and args["cfg_scale"] == parser.get_default("cfg_scale"):
-        args["cfg_scale"] = 125.0
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="If set, torch.compile the diffusion model before sampling (CUDA only); "
+        "can also be enabled with SLUGBOT_COMPILE=1",
+    )
+    parser.add_argument(
+        "--compile_mode",
+        choices=["default", "reduce-overhead", "max-autotune"],
+        help="torch.compile mode used with --compile (default: reduce-overhead)",
+    )
+    args = simple_prompt_args(parser.parse_args().__dict__)
 
     # args["cfg_scale"] = args["strength"]
     # args["cfg_scale"] = args["strength"] if args["init_audio"] is None else 150.0
@@ -469,6 +804,33 @@ def simple_prompt() -> None:
     shared_model_invocation(args, InvocationType.SPROMPT)
 
 
+def args_from_toml(toml: dict):
+    """
+    Build the invocation args from a parsed TOML prompt (or an equivalent JSON object), returning
+    them alongside the invocation type they call for
+    """
+    config = toml.get("config") or {}
+
+    prompts = toml.get("prompts", None)
+    if prompts is None:
+        if config.get("prompt") is not None:
+            return simple_prompt_args(config), InvocationType.SPROMPT
+        raise ValueError("No prompts received")
+
+    args = default_cfg | preset_cfg(config.get("preset")) | config
+    prompts = [{"prompt": k, "weight": v} for k, v in prompts.items()]
+    args["prompts"] = prompts
+
+    neg_prompts = toml.get("neg_prompts", None)
+    if neg_prompts is not None:
+        neg_prompts = [{"prompt": k, "weight": v} for k, v in neg_prompts.items()]
+        args["neg_prompts"] = neg_prompts
+
+    args["inpaint"] = toml.get("inpaint", None)
+
+    return args, InvocationType.NPROMPT if args["inpaint"] is None else InvocationType.INPAINT
+
+
 def toml_prompt() -> None:
     parser = argparse.ArgumentParser(description="Generate audio with Stable Audio Open 1.0")
     parser.add_argument("--output", type=str, default="", help="Output WAV file path")
@@ -478,19 +840,15 @@ def toml_prompt() -> None:
     args_in = parser.parse_args().__dict__
     try:
         input = stdin.read()
-        toml = loads(input)
-        args = default_cfg
-        if toml.get("config") is not None:
-            args = default_cfg | toml["config"]
+        toml = toml_loads(input)
 
         print("got TOML: ")
         print(toml)
-        prompts = toml.get("prompts", None)
-        if prompts is None:
-            print("No prompts received. Exiting...")
+        try:
+            args, inv_type = args_from_toml(toml)
+        except ValueError as e:
+            print(f"{e}. Exiting...")
             exit(1)
-        prompts = [{"prompt": k, "weight": v} for k, v in prompts.items()]
-        args["prompts"] = prompts
 
         if args_in.get("output"):
             args["output"] = args_in.get("output")
@@ -499,24 +857,43 @@ def toml_prompt() -> None:
         if args_in.get("init_audio"):
             args["init_audio"] = args_in.get("init_audio")
 
-        neg_prompts = toml.get("neg_prompts", None)
-        if neg_prompts is not None:
-            neg_prompts = [{"prompt": k, "weight": v} for k, v in neg_prompts.items()]
-            args["neg_prompts"] = neg_prompts
-
-        args["inpaint"] = toml.get("inpaint", None)
+        shared_model_invocation(args, inv_type)
+    except TOMLDecodeError as e:
+        print(f"rain into TOML decode error: {e}")
 
 
-        shared_model_invocation(
-            args, InvocationType.NPROMPT if args["inpaint"] is None else InvocationType.INPAINT
-        )
-    except tomllib.TOMLDecodeError as e:
-        print(f"rain into TOML decode error: {e}")
+def serve() -> None:
+    """
+    Long-running mode: keep the model(s) loaded and handle one request per line of stdin. Each
+    request is a JSON object laid out like a TOML prompt (ie. `config`, `prompts`, `neg_prompts`,
+    and `inpaint` tables, with `output`/`progress_file`/`init_audio` going in `config`); a request
+    with no `prompts` but a `config.prompt` is treated as a simple prompt, with the same defaults
+    as the CLI's.
+
+    stdout carries only the protocol: one JSON status line per request. All other output (ours
+    and stable-audio-tools') goes to stderr while serving
+    """
+    status_out = sys.stdout
+    with redirect_stdout(sys.stderr):
+        print("Serving requests from stdin...", flush=True)
+        while line := stdin.readline():
+            if not line.strip():
+                continue
+            try:
+                args, inv_type = args_from_toml(json_loads(line))
+                shared_model_invocation(args, inv_type)
+                status = {"ok": True, "output": args["output"]}
+            except Exception as e:
+                print(f"Request failed: {e}", flush=True)
+                status = {"ok": False, "error": str(e)}
+            print(json_dumps(status), file=status_out, flush=True)
 
 
 def main() -> None:
     # if there's something on stdin, assume it's a TOML prompt
-    if "--toml" in sys.argv:
+    if "--serve" in sys.argv:
+        serve()
+    elif "--toml" in sys.argv:
         print("Using !!!TOML PROMPT!!! !!!EXPERIMENTAL!!!")
         toml_prompt()
     else:
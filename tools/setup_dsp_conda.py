@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import json
+import os
 import shutil
 import subprocess
 import sys
@@ -14,11 +16,32 @@ def run(cmd):
     subprocess.run(cmd, check=True)
 
 
+def has_libmamba_solver(conda_cmd) -> bool:
+    """Whether plain conda's base env has the libmamba solver plugin installed"""
+    result = subprocess.run(
+        [conda_cmd, "list", "--name", "base", "--json", "conda-libmamba-solver"],
+        capture_output=True,
+        text=True,
+    )
+    try:
+        return result.returncode == 0 and len(json.loads(result.stdout)) > 0
+    except ValueError:
+        return False
+
+
 def main():
     conda_cmd = shutil.which("mamba") or shutil.which("conda")
     if not conda_cmd:
         sys.exit("Error: neither 'mamba' nor 'conda' found on PATH. Please install one of these.")
 
+    # mamba is preferred above since it always solves with libmamba; plain conda only does by
+    # default from 23.10 onwards, so ask for it explicitly, but only when the plugin is there
+    # (conda errors out on an unknown solver). Strict channel priority also shrinks the search
+    # space, since lower-priority channels are skipped
+    if Path(conda_cmd).stem == "conda" and has_libmamba_solver(conda_cmd):
+        os.environ.setdefault("CONDA_SOLVER", "libmamba")
+    os.environ.setdefault("CONDA_CHANNEL_PRIORITY", "strict")
+
     if not ENV_CONFIG.exists():
         sys.exit(f"Error: Conda environment config '{ENV_CONFIG}' does not exist.")
 
@@ -11,6 +11,8 @@ Usage:
 Requirements:
 - `conda` or `mamba` executable on your PATH
 """
+import json
+import os
 import sys
 import shutil
 import subprocess
@@ -19,6 +21,9 @@ from pathlib import Path
 # Configuration
 ENV_DIR = Path(".conda-env")
 PYTHON_VERSION = "3.11"
+# Where to get CUDA builds of torch/torchaudio from; override with TORCH_INDEX_URL for a different
+# CUDA version (or eg. https://download.pytorch.org/whl/cpu)
+TORCH_INDEX_URL = os.environ.get("TORCH_INDEX_URL", "https://download.pytorch.org/whl/cu121")
 
 
 def run(cmd):
@@ -26,12 +31,31 @@ def run(cmd):
     subprocess.run(cmd, check=True)
 
 
+def has_libmamba_solver(conda_cmd) -> bool:
+    """Whether plain conda's base env has the libmamba solver plugin installed"""
+    result = subprocess.run(
+        [conda_cmd, "list", "--name", "base", "--json", "conda-libmamba-solver"],
+        capture_output=True,
+        text=True,
+    )
+    try:
+        return result.returncode == 0 and len(json.loads(result.stdout)) > 0
+    except ValueError:
+        return False
+
+
 def main():
     # Locate conda or mamba
     conda_cmd = shutil.which("mamba") or shutil.which("conda")
     if not conda_cmd:
         sys.exit("Error: neither 'mamba' nor 'conda' found on PATH. Please install one of these.")
 
+    # Same solver settings as setup_dsp_conda.py: libmamba (mamba's solver), if plain conda has
+    # it, and strict channel priority
+    if Path(conda_cmd).stem == "conda" and has_libmamba_solver(conda_cmd):
+        os.environ.setdefault("CONDA_SOLVER", "libmamba")
+    os.environ.setdefault("CONDA_CHANNEL_PRIORITY", "strict")
+
     # Create environment if missing
     if not ENV_DIR.exists():
         print(f"Creating Conda environment at {ENV_DIR} with Python {PYTHON_VERSION}...")
@@ -51,11 +75,31 @@ def main():
 
     # Install or upgrade packages via pip
     pip_cmd = [conda_cmd, "run", "--prefix", str(ENV_DIR), "pip", "install", "--upgrade"]
-    print("Upgrading pip, setuptools, wheel, and numpy...")
-    run(pip_cmd + ["pip", "setuptools", "wheel", "numpy"])
+    # pip goes first on its own so the upgraded resolver handles everything after it
+    print("Upgrading pip, setuptools, and wheel...")
+    run(pip_cmd + ["pip", "setuptools", "wheel"])
+
+    # Install torch from its CUDA index up front; stable-audio-tools' resolver then finds it
+    # already satisfied instead of pulling in a CPU-only wheel from PyPI
+    print(f"Installing torch and torchaudio from {TORCH_INDEX_URL}...")
+    run(pip_cmd + ["--index-url", TORCH_INDEX_URL, "torch", "torchaudio"])
 
-    print("Installing stable-audio-tools...")
-    run(pip_cmd + ["--prefer-binary", "stable-audio-tools"])
+    # Everything else in one resolver pass (and one `conda run`): stable-audio-tools, the faster
+    # config parsers that generate.py uses when present, and the Hugging Face downloader backend
+    # used by tools/clone-repo.py
+    print("Installing stable-audio-tools and helpers...")
+    run(
+        pip_cmd
+        + [
+            "--prefer-binary",
+            "numpy",
+            "stable-audio-tools",
+            "orjson",
+            "rtoml",
+            "huggingface_hub",
+            "hf_transfer",
+        ]
+    )
 
     print("Verifying installation...")
     run([conda_cmd, "run", "--prefix", str(ENV_DIR), "pip", "show", "stable-audio-tools"])